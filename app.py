@@ -1,9 +1,19 @@
 from fastapi import FastAPI, HTTPException, APIRouter
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 from prophet import Prophet
 from holidays import CountryHoliday
+import holidays as holidays_lib
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+from statistics import NormalDist
+import functools
 import logging
+import os
 import uvicorn
 import asyncio
 
@@ -11,19 +21,66 @@ import asyncio
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
 
-# Initialize the FastAPI app
-app = FastAPI()
+# Country codes and names accepted by the holidays library, resolved once at import
+SUPPORTED_COUNTRIES = frozenset(holidays_lib.list_supported_countries()) | frozenset(
+    name for name in dir(holidays_lib.countries)
+    if isinstance(getattr(holidays_lib.countries, name), type)
+)
+
+# Pandas offset aliases for the supported input frequencies
+FREQ_MAP = {'monthly': 'ME', 'weekly': 'W'}
+
+# Proleptic Gregorian ordinal of 1970-01-01, used to turn dates into epoch day offsets
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Initialize the FastAPI app, serializing responses with orjson
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Compress responses large enough to benefit (long prediction periods); a low level keeps CPU cost small
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=4)
+
+# Dummy fit so each worker loads Prophet's Stan backend before the first real request
+def warm_prophet():
+    Prophet().fit(pd.DataFrame({
+        'ds': pd.date_range('2020-01-01', periods=4, freq='ME'),
+        'y': [1.0, 2.0, 3.0, 4.0]
+    }))
+
+# Process pool for the CPU-bound Prophet work, one worker per forecast series at most
+POOL_SIZE = min(3, os.cpu_count() or 1)
+
+def create_executor():
+    return ProcessPoolExecutor(max_workers=POOL_SIZE, initializer=warm_prophet)
+
+EXECUTOR = create_executor()
+
+# A crashed worker (OOM, cmdstan segfault) breaks the whole pool for good, so swap in a fresh one
+def reset_executor(broken):
+    global EXECUTOR
+    if EXECUTOR is broken:
+        logger.error("Forecast worker pool is broken, restarting it")
+        EXECUTOR = create_executor()
+        broken.shutdown(wait=False, cancel_futures=True)
+
+# Every pool worker keeps its own model cache, so split the budget to bound total memory
+MODEL_CACHE_SIZE = max(1, 256 // POOL_SIZE)
 
 # Create a new router for version 1 (v1)
-v1_router = APIRouter(prefix="/v1")
+v1_router = APIRouter(prefix="/v1", default_response_class=ORJSONResponse)
+
+# Savings details, coerced to floats by Pydantic at parse time
+class SavingsModel(BaseModel):
+    current_savings: float = 0
+    monthly_contribution: float = 0
+    goal: float = 0
 
 # Define the data model for the incoming request using Pydantic
 class PredictionRequest(BaseModel):
-    expenses: list = None
+    expenses: list[float] | None = None
     expenses_start_date: str = None  # New field for expenses start date
-    incomes: list = None
+    incomes: list[float] | None = None
     incomes_start_date: str = None  # New field for incomes start date
-    savings: dict = None
+    savings: SavingsModel | None = None
     savings_start_date: str = None  # New field for savings start date
     frequency: str = "monthly"  # Default to monthly if not provided
     country: str = "Kenya"  # Default to Kenya if not provided
@@ -32,19 +89,35 @@ class PredictionRequest(BaseModel):
     tax_rate: float = 0.1  # Default tax rate of 10%
     enable_seasonality: bool = False  # Option to enable seasonality
     enable_holidays: bool = False  # Option to enable holidays
+    uncertainty_samples: int = Field(100, ge=0)  # Posterior samples for Prophet's intervals (0 uses the noise band)
+
+    # An empty savings object ({}) means no savings forecast, as it did when savings was a plain dict
+    @property
+    def has_savings(self):
+        return self.savings is not None and bool(self.savings.model_fields_set)
 
 
-# Function to create a dataframe for Prophet
+# Function to create a dataframe for Prophet from pre-typed columns (no object-dtype inference)
 def create_dataframe(dates, values):
-    return pd.DataFrame({'ds': dates, 'y': values})
+    return pd.DataFrame({
+        'ds': np.asarray(dates, dtype='datetime64[ns]'),
+        'y': np.asarray(values, dtype=np.float64)
+    }, copy=False)
 
-# Helper to generate country-specific holidays
+# Helper to generate country-specific holidays (memoized per country, treat the result as read-only)
+@functools.lru_cache(maxsize=64)
 def get_holidays(country: str):
+    if country not in SUPPORTED_COUNTRIES:
+        logger.error(f"Country {country} not supported")
+        return pd.DataFrame(columns=['ds', 'holiday'])
     try:
         holidays = CountryHoliday(country)
+        # Convert via day offsets from the Unix epoch in one typed pass (no object-dtype column)
+        days = np.fromiter((d.toordinal() - UNIX_EPOCH_ORDINAL for d in holidays), dtype=np.int32, count=len(holidays))
+        ds = pd.to_datetime(days, unit='D', cache=True)
         return pd.DataFrame({
-            'ds': list(holidays),
-            'holiday': [1] * len(holidays)
+            'ds': ds,
+            'holiday': np.ones(len(ds), dtype=np.int8)
         })
     except Exception:
         logger.error(f"Country {country} not supported")
@@ -52,18 +125,22 @@ def get_holidays(country: str):
 
 # Function to apply tax deductions to incomes 
 def apply_tax_deductions(incomes: list, tax_rate: float):
-    return [income * (1 - tax_rate) for income in incomes]
-
-# General Forecasting Function for Incomes/Expenses with optional seasonality and holidays
-def forecast_data(dates, values, country, prediction_period, enable_seasonality, enable_holidays, tax_deductions=False, tax_rate=0.1):
-    df = create_dataframe(dates, values)
-
-    # Instantiate a new Prophet model for each request
-    model = Prophet()
-
-    # Apply tax deduction if enabled
-    if tax_deductions:
-        values = apply_tax_deductions(values, tax_rate)
+    return np.asarray(incomes, dtype=np.float64) * (1.0 - tax_rate)
+
+# Fit (or reuse) a Prophet model for the given series and options.
+# Fitting dominates request latency, so identical inputs share one fitted model.
+# The cache is per pool worker and requests land on workers at random, so hits are best effort.
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def _get_fitted_model(dates_key, values_key, country, enable_seasonality, enable_holidays):
+    df = create_dataframe(dates_key, values_key)
+    # Only fit the seasonalities we ask for; Prophet's yearly/weekly/daily defaults
+    # inflate the Fourier design matrix and don't suit monthly/weekly financial series
+    model = Prophet(
+        yearly_seasonality=False,
+        weekly_seasonality=False,
+        daily_seasonality=False,
+        mcmc_samples=0
+    )
 
     # Add monthly seasonality if enabled
     if enable_seasonality:
@@ -76,118 +153,220 @@ def forecast_data(dates, values, country, prediction_period, enable_seasonality,
             model = model.add_country_holidays(country_name=country)
 
     model.fit(df)
-    future = model.make_future_dataframe(periods=prediction_period, freq='ME')
-    forecast = model.predict(future)
-
-    # Format the 'ds' column to only return the date in YYYY-MM-DD format
-    forecast['ds'] = forecast['ds'].dt.strftime('%Y-%m-%d')
+    return model
+
+# Half-width of the observation-noise interval at the model's interval width
+def noise_band(model):
+    z = NormalDist().inv_cdf(0.5 + model.interval_width / 2)
+    return z * np.nanmean(model.params['sigma_obs']) * model.y_scale
+
+# Fast path for plain models: evaluate the fitted trend and Fourier seasonalities directly
+# from the MAP parameters instead of running Prophet's DataFrame-heavy predict pipeline.
+# Intervals still come from Prophet's posterior simulation (trend changepoints + noise) unless
+# sampling is disabled, in which case a constant observation-noise band is used.
+# Holidays, regressors, logistic growth and multiplicative terms fall back to model.predict.
+def predict_forecast(model, future, uncertainty_samples=100):
+    # Sampling only affects predict, so it's set on the shared cached model here rather than
+    # being part of the fit cache key (each pool worker runs one forecast at a time)
+    model.uncertainty_samples = uncertainty_samples
+    if (model.growth != 'linear' or model.holidays is not None or model.country_holidays is not None
+            or model.extra_regressors
+            or any(props['mode'] != 'additive' or props['condition_name'] is not None
+                   for props in model.seasonalities.values())):
+        forecast = model.predict(future)
+        # Prophet omits the interval columns when sampling is disabled
+        if model.uncertainty_samples == 0:
+            band = noise_band(model)
+            forecast['yhat_lower'] = forecast['yhat'] - band
+            forecast['yhat_upper'] = forecast['yhat'] + band
+        return forecast
+
+    # Prophet's own setup gives the scaled time axis and floor used during fit
+    df = model.setup_dataframe(future.copy())
+    k = np.nanmean(model.params['k'])
+    m = np.nanmean(model.params['m'])
+    deltas = np.nanmean(model.params['delta'], axis=0)
+    yhat = (model.piecewise_linear(df['t'].values, deltas, k, m, model.changepoints_t) * model.y_scale
+            + df['floor'].values)
+
+    # Seasonal columns are laid out in the same order as model.seasonalities during fit
+    if model.seasonalities:
+        beta = np.nanmean(model.params['beta'], axis=0)
+        features = np.hstack([
+            model.fourier_series(df['ds'], props['period'], props['fourier_order'])
+            for props in model.seasonalities.values()
+        ])
+        yhat = yhat + features @ beta * model.y_scale
+
+    if model.uncertainty_samples:
+        intervals = model.predict_uncertainty(df, vectorized=True)
+        yhat_lower = intervals['yhat_lower'].values
+        yhat_upper = intervals['yhat_upper'].values
+    else:
+        band = noise_band(model)
+        yhat_lower = yhat - band
+        yhat_upper = yhat + band
+    return pd.DataFrame({'ds': df['ds'].values, 'yhat': yhat, 'yhat_lower': yhat_lower, 'yhat_upper': yhat_upper})
 
-    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(prediction_period).to_dict(orient='records')
+# General Forecasting Function for Incomes/Expenses with optional seasonality and holidays
+def forecast_data(dates, values, country, prediction_period, enable_seasonality, enable_holidays, tax_deductions=False, tax_rate=0.1, uncertainty_samples=100):
+    # Apply tax deduction if enabled (before fitting, so the model sees net values)
+    if tax_deductions:
+        values = apply_tax_deductions(values, tax_rate)
 
-def forecast_savings(savings, start_date, prediction_period, country, enable_seasonality, enable_holidays):
-    current_savings = savings.get('current_savings', 0)
-    monthly_contribution = savings.get('monthly_contribution', 0)
-    goal = savings.get('goal', 0)
+    # Reuse a cached model if this exact series has been fitted before
+    model = _get_fitted_model(tuple(dates), tuple(values), country, enable_seasonality, enable_holidays)
 
-    # Generate dates for the forecast periods
-    dates = pd.date_range(start=start_date, periods=prediction_period, freq='ME')
-    savings_values = [current_savings + i * monthly_contribution for i in range(prediction_period)]
+    future = model.make_future_dataframe(periods=prediction_period, freq='ME')
+    forecast = predict_forecast(model, future, uncertainty_samples)
 
-    df = create_dataframe(dates, savings_values)
+    # Format the 'ds' column to only return the date in YYYY-MM-DD format
+    forecast['ds'] = forecast['ds'].values.astype('datetime64[D]').astype(str)
 
-    # Instantiate a new Prophet model for each request
-    model = Prophet()
+    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(prediction_period).to_dict(orient='records')
 
-    # Add holidays if enabled
-    if enable_holidays:
-        holidays_df = get_holidays(country)
-        if not holidays_df.empty:
-            model = model.add_country_holidays(country_name=country)
+def forecast_savings(savings, dates, prediction_period, country, enable_seasonality, enable_holidays, uncertainty_samples=100):
+    current_savings = savings.current_savings
+    monthly_contribution = savings.monthly_contribution
+    goal = savings.goal
 
-    model.fit(df)
-    future = model.make_future_dataframe(periods=prediction_period, freq='ME')
-    forecast = model.predict(future)
+    # `dates` holds the monthly history dates, one per forecast period
+    savings_values = current_savings + np.arange(prediction_period) * monthly_contribution
 
-    # Ensure savings cannot go below zero by capping the lower bound at 0
-    forecast['yhat'] = forecast['yhat'].apply(lambda x: max(x, 0))
+    # Holidays are the only thing Prophet could add on top of the exact line, so only fit when some exist
+    if enable_holidays and not get_holidays(country).empty:
+        # Reuse a cached model if this exact series has been fitted before (no seasonality for savings)
+        model = _get_fitted_model(tuple(dates), tuple(savings_values), country, False, enable_holidays)
+        future = model.make_future_dataframe(periods=prediction_period, freq='ME')
+        forecast = predict_forecast(model, future, uncertainty_samples)
+    else:
+        # The savings series is exactly linear, so extend the line instead of fitting Prophet to it
+        future_dates = pd.date_range(start=dates[-1], periods=prediction_period + 1, freq='ME')[1:]
+        yhat = current_savings + np.arange(prediction_period, 2 * prediction_period) * monthly_contribution
+        band = np.abs(yhat) * 0.05
+        forecast = pd.DataFrame({'ds': future_dates, 'yhat': yhat, 'yhat_lower': yhat - band, 'yhat_upper': yhat + band})
+
+    # Ensure savings cannot go below zero by capping the lower bound at 0, then derive
+    # the goal columns from that one clipped array instead of re-reading the column
+    yhat = np.maximum(forecast['yhat'].values, 0.0)
+    forecast['yhat'] = yhat
+    forecast['goal_met'] = np.where(yhat >= goal, 'Yes', 'No')
+    forecast['surplus_or_deficit'] = yhat - goal
 
     # Format the 'ds' column to return dates in YYYY-MM-DD format
-    forecast['ds'] = forecast['ds'].dt.strftime('%Y-%m-%d')
-
-    forecast['goal_met'] = forecast['yhat'].apply(lambda x: 'Yes' if x >= goal else 'No')
-    forecast['surplus_or_deficit'] = forecast['yhat'].apply(lambda x: x - goal)
+    forecast['ds'] = forecast['ds'].values.astype('datetime64[D]').astype(str)
 
     return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper', 'goal_met', 'surplus_or_deficit']].tail(prediction_period).to_dict(orient='records')
 
 
 
+# Memoized date range; DatetimeIndex is immutable, so callers can share the cached index
+@functools.lru_cache(maxsize=512)
+def _date_range(start_date: str, freq: str, length: int):
+    return pd.date_range(start=pd.to_datetime(start_date), periods=length, freq=freq)
+
 # Helper to process the dates for input data
 def get_dates(start_date, frequency, length):
-    start = pd.to_datetime(start_date)
-    if frequency == "monthly":
-        return pd.date_range(start=start, periods=length, freq='ME')
-    elif frequency == "weekly":
-        return pd.date_range(start=start, periods=length, freq='W')
-    else:
+    if frequency not in FREQ_MAP:
         logger.error("Unsupported frequency")
         raise ValueError("Unsupported frequency")
+    return _date_range(start_date, FREQ_MAP[frequency], length)
+
+# Build one date index per (start date, frequency) covering the longest series that uses it,
+# and hand each series a slice of it instead of regenerating the range per series
+def get_shared_dates(spans):
+    longest = {}
+    for start_date, frequency, length in spans:
+        key = (start_date, frequency)
+        longest[key] = max(longest.get(key, 0), length)
+    indexes = {key: get_dates(key[0], key[1], length) for key, length in longest.items()}
+    return [indexes[(start_date, frequency)][:length] for start_date, frequency, length in spans]
 
 
-# Main prediction function using asyncio for parallelism
+# Main prediction function, fanning the forecasts out to the process pool for parallelism
 async def process_predictions(data: PredictionRequest):
+    # Initialize the result dictionary; failed series are reported under "errors"
+    result_dict = {
+        "expense_predictions": None,
+        "income_predictions": None,
+        "savings_predictions": None,
+        "errors": {}
+    }
+
+    # Nothing to forecast, skip scheduling entirely
+    if not (data.expenses or data.incomes or data.has_savings):
+        return result_dict
+
+    executor = EXECUTOR
     try:
+        loop = asyncio.get_running_loop()
         tasks = []
+        fields = []
+
+        # Resolve the history dates for every provided series (savings are always monthly)
+        spans = []
+        if data.expenses:
+            spans.append((data.expenses_start_date or data.start_date, data.frequency, len(data.expenses)))
+        if data.incomes:
+            spans.append((data.incomes_start_date or data.start_date, data.frequency, len(data.incomes)))
+        if data.has_savings:
+            spans.append((data.savings_start_date or data.start_date, "monthly", data.prediction_period))
+        series_dates = iter(get_shared_dates(spans))
 
-        # Add expense prediction task if expenses data is provided
+        # Add expense prediction task if expenses data is provided (tax deductions only apply to incomes)
         if data.expenses:
-            dates = get_dates(data.expenses_start_date or data.start_date, data.frequency, len(data.expenses))
-            tasks.append(asyncio.to_thread(
+            dates = next(series_dates)
+            fields.append("expense_predictions")
+            tasks.append(loop.run_in_executor(executor, functools.partial(
                 forecast_data, dates, data.expenses, data.country, data.prediction_period, 
-                data.enable_seasonality, data.enable_holidays, data.tax_deductions, data.tax_rate
-            ))
+                data.enable_seasonality, data.enable_holidays, False, data.tax_rate,
+                data.uncertainty_samples
+            )))
 
         # Add income prediction task if incomes data is provided
         if data.incomes:
-            dates = get_dates(data.incomes_start_date or data.start_date, data.frequency, len(data.incomes))
-            tasks.append(asyncio.to_thread(
+            dates = next(series_dates)
+            fields.append("income_predictions")
+            tasks.append(loop.run_in_executor(executor, functools.partial(
                 forecast_data, dates, data.incomes, data.country, data.prediction_period, 
-                data.enable_seasonality, data.enable_holidays, data.tax_deductions, data.tax_rate
-            ))
+                data.enable_seasonality, data.enable_holidays, data.tax_deductions, data.tax_rate,
+                data.uncertainty_samples
+            )))
 
         # Add savings prediction task if savings data is provided
-        if data.savings:
-            dates = get_dates(data.savings_start_date or data.start_date, data.frequency, data.prediction_period)
-            tasks.append(asyncio.to_thread(
-                forecast_savings, data.savings, data.savings_start_date or data.start_date, data.prediction_period, 
-                data.country, data.enable_seasonality, data.enable_holidays
-            ))
-
-        # Run all the tasks concurrently and gather results
-        results = await asyncio.gather(*tasks)
-
-        # Initialize the result dictionary
-        result_dict = {
-            "expense_predictions": None,
-            "income_predictions": None,
-            "savings_predictions": None
-        }
-
-        result_index = 0
-        if data.expenses:
-            result_dict["expense_predictions"] = results[result_index]
-            result_index += 1
-        if data.incomes:
-            result_dict["income_predictions"] = results[result_index]
-            result_index += 1
-        if data.savings:
-            result_dict["savings_predictions"] = results[result_index]
+        if data.has_savings:
+            dates = next(series_dates)
+            fields.append("savings_predictions")
+            tasks.append(loop.run_in_executor(executor, functools.partial(
+                forecast_savings, data.savings, dates, data.prediction_period, 
+                data.country, data.enable_seasonality, data.enable_holidays, data.uncertainty_samples
+            )))
 
-        return result_dict
+        # Run all the tasks concurrently; a failing series doesn't cancel the others
+        results = await asyncio.gather(*tasks, return_exceptions=True)
 
     except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            reset_executor(executor)
         logger.error(f"Prediction processing failed: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    if any(isinstance(result, BrokenProcessPool) for result in results):
+        reset_executor(executor)
+
+    for field, result in zip(fields, results):
+        if isinstance(result, Exception):
+            logger.error(f"Prediction for {field} failed: {str(result)}")
+            result_dict["errors"][field] = str(result)
+        else:
+            result_dict[field] = result
+
+    # Only fail the whole request when every series failed
+    if len(result_dict["errors"]) == len(fields):
+        raise HTTPException(status_code=500, detail=result_dict["errors"])
+
+    return result_dict
+
 
 
 # Async route for FastAPI to handle incoming predictions
@@ -197,14 +376,39 @@ async def predict_financials(data: PredictionRequest):
     try:
         result = await process_predictions(data)
         logger.info("Prediction successfully processed")
-        return result
+        # Return the response directly so FastAPI skips its jsonable_encoder pass over the records
+        return ORJSONResponse(result)
+    except HTTPException:
+        # Already carries its status and (possibly per-field) detail
+        raise
     except Exception as e:
         logger.error(f"Error in prediction endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Start (and thereby warm) the forecast worker processes before serving requests
+@app.on_event("startup")
+async def start_executor():
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(EXECUTOR, os.getpid) for _ in range(POOL_SIZE)))
+
+# Release the forecast worker processes when the app shuts down
+@app.on_event("shutdown")
+async def shutdown_executor():
+    EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 # Include the versioned router in the FastAPI app
 app.include_router(v1_router)
 
 # Run the FastAPI app
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    if os.getenv("APP_ENV") == "dev":
+        # Single auto-reloading process for local development
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # Each worker owns a POOL_SIZE process pool, so size workers to avoid oversubscribing cores.
+        # loop/http "auto" pick uvloop and httptools when installed (uvicorn[standard], not on Windows)
+        uvicorn.run(
+            "app:app", host="0.0.0.0", port=8000,
+            workers=max(1, (os.cpu_count() or 1) // POOL_SIZE),
+            loop="auto", http="auto", reload=False
+        )
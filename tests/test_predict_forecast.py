@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("prophet")
+pytest.importorskip("fastapi")
+
+import app
+
+
+def fit_model(enable_seasonality, uncertainty_samples):
+    dates = tuple(pd.date_range("2022-01-01", periods=24, freq="ME"))
+    rng = np.random.default_rng(0)
+    values = tuple(1000 + 25 * np.arange(24) + rng.normal(0, 30, 24))
+    model = app._get_fitted_model(dates, values, "Kenya", enable_seasonality, False)
+    # The model is cached and shared, so set the sample count for model.predict explicitly
+    model.uncertainty_samples = uncertainty_samples
+    return model
+
+
+@pytest.mark.parametrize("enable_seasonality", [False, True])
+def test_fast_path_matches_prophet_predict(enable_seasonality):
+    model = fit_model(enable_seasonality, 100)
+    future = model.make_future_dataframe(periods=6, freq="ME")
+
+    # Both paths draw intervals from the same posterior simulation, so a shared seed must agree
+    np.random.seed(0)
+    expected = model.predict(future)
+    np.random.seed(0)
+    forecast = app.predict_forecast(model, future, 100)
+
+    np.testing.assert_array_equal(forecast['ds'].values, expected['ds'].values)
+    for column in ['yhat', 'yhat_lower', 'yhat_upper']:
+        np.testing.assert_allclose(forecast[column].values, expected[column].values, rtol=1e-8)
+
+
+@pytest.mark.parametrize("enable_seasonality", [False, True])
+def test_fast_path_without_sampling_uses_noise_band(enable_seasonality):
+    model = fit_model(enable_seasonality, 0)
+    future = model.make_future_dataframe(periods=6, freq="ME")
+
+    expected = model.predict(future)
+    forecast = app.predict_forecast(model, future, 0)
+
+    np.testing.assert_allclose(forecast['yhat'].values, expected['yhat'].values, rtol=1e-8)
+    band = app.noise_band(model)
+    np.testing.assert_allclose(forecast['yhat_upper'].values - forecast['yhat'].values, band)
+    np.testing.assert_allclose(forecast['yhat'].values - forecast['yhat_lower'].values, band)